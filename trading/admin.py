@@ -1,6 +1,60 @@
 from django.contrib import admin
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import F
+from django.utils.functional import cached_property
 from .models import TradingPair, Order, Wallet
 
+PAIR_CHOICES_CACHE_KEY = 'trading:pair_choices'
+PAIR_CHOICES_TTL = 300
+
+def get_pair_choices():
+    """
+    (id, symbol) for every pair, for the order list filter.
+
+    Kept in the Django cache rather than per process, so a pair added via one
+    worker shows up on the others - immediately with a shared cache backend,
+    within PAIR_CHOICES_TTL otherwise. Deleted by the TradingPair signals.
+    """
+    choices = cache.get(PAIR_CHOICES_CACHE_KEY)
+    if choices is None:
+        choices = tuple(TradingPair.objects.order_by('symbol').values_list('id', 'symbol'))
+        cache.set(PAIR_CHOICES_CACHE_KEY, choices, PAIR_CHOICES_TTL)
+    return choices
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the planner's row estimate from pg_class for unfiltered listings
+    of big tables instead of a full COUNT(*). Filtered querysets, small
+    tables and other backends get the exact count.
+    """
+    ESTIMATE_THRESHOLD = 100_000
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        connection = connections[qs.db]
+        if connection.vendor == 'postgresql' and not qs.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                    [qs.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            if row and row[0] > self.ESTIMATE_THRESHOLD:
+                return row[0]
+        return super().count
+
+class ModelAdminEstimateCountMixin:
+    paginator = EstimatedCountPaginator
+    # The "N total" link would run the exact COUNT(*) anyway
+    show_full_result_count = False
+
+class CachedPairListFilter(admin.RelatedFieldListFilter):
+    def field_choices(self, field, request, model_admin):
+        return get_pair_choices()
+
 @admin.register(TradingPair)
 class TradingPairAdmin(admin.ModelAdmin):
     list_display = ['symbol', 'base_currency', 'quote_currency', 'is_active', 'created_at']
@@ -9,15 +63,14 @@ class TradingPairAdmin(admin.ModelAdmin):
     readonly_fields = ['created_at']
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(ModelAdminEstimateCountMixin, admin.ModelAdmin):
     list_display = ['id', 'user', 'pair', 'side', 'order_type', 'price', 'amount', 'status', 'created_at']
-    list_filter = ['side', 'order_type', 'status', 'pair', 'created_at']
+    list_filter = ['side', 'order_type', 'status', ('pair', CachedPairListFilter), 'created_at']
     search_fields = ['user__username', 'pair__symbol']
     readonly_fields = ['created_at', 'updated_at', 'filled_amount']
     ordering = ['-created_at']
-    
-    def get_queryset(self, request):
-        return super().get_queryset(request).select_related('user', 'pair')
+    list_select_related = ['user', 'pair']
+    raw_id_fields = ['user', 'pair']
 
 @admin.register(Wallet)
 class WalletAdmin(admin.ModelAdmin):
@@ -27,8 +80,11 @@ class WalletAdmin(admin.ModelAdmin):
     readonly_fields = ['created_at', 'available_balance']
     
     def available_balance(self, obj):
-        return obj.available_balance
+        return obj._available
     available_balance.short_description = 'Available'
+    available_balance.admin_order_field = '_available'
     
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('user')
\ No newline at end of file
+        return super().get_queryset(request).select_related('user').annotate(
+            _available=F('balance') - F('locked_balance')
+        )
\ No newline at end of file
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.6 on 2026-10-15 09:42
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+from django.db.migrations.operations import AddIndex
+
+
+class AddIndexConcurrentlyIfPostgres(AddIndexConcurrently):
+    """CREATE INDEX CONCURRENTLY on PostgreSQL, a plain AddIndex elsewhere."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    # CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('trading', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyIfPostgres(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', 'OPEN')), fields=['pair', 'side', 'price', 'created_at'], name='open_orders_idx'),
+        ),
+        AddIndexConcurrentlyIfPostgres(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', 'OPEN')), fields=['pair', 'side', '-price', 'created_at'], name='open_orders_desc_idx'),
+        ),
+        AddIndexConcurrentlyIfPostgres(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', 'OPEN')), fields=['user', 'created_at'], name='user_open_orders_idx'),
+        ),
+    ]
@@ -1,6 +1,8 @@
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User  # Fixed: Capital U
 from decimal import Decimal
+from functools import cached_property
 
 class TradingPair(models.Model):
     symbol = models.CharField(max_length=20, unique=True)  # e.g., "BTC/USDT"
@@ -45,6 +47,23 @@ class Order(models.Model):
         indexes = [
             models.Index(fields=['pair', 'status']),
             models.Index(fields=['user', 'created_at']),
+            # Matching scans: asks lowest price first, bids highest first.
+            # Partial so filled/cancelled history never enters these.
+            models.Index(
+                fields=['pair', 'side', 'price', 'created_at'],
+                name='open_orders_idx',
+                condition=Q(status='OPEN'),
+            ),
+            models.Index(
+                fields=['pair', 'side', '-price', 'created_at'],
+                name='open_orders_desc_idx',
+                condition=Q(status='OPEN'),
+            ),
+            models.Index(
+                fields=['user', 'created_at'],
+                name='user_open_orders_idx',
+                condition=Q(status='OPEN'),
+            ),
         ]
 
     def __str__(self): 
@@ -60,9 +79,17 @@ class Wallet(models.Model):
     class Meta:
         unique_together = ['user', 'currency']
 
-    @property
+    @cached_property
     def available_balance(self):
         return self.balance - self.locked_balance
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.__dict__.pop('available_balance', None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.__dict__.pop('available_balance', None)
+
     def __str__(self):
         return f"{self.user.username} - {self.currency}: {self.balance}"
\ No newline at end of file
@@ -3,18 +3,40 @@ Trading services - business logic for wallets, orders, and matching.
 """
 
 import logging
+from collections import defaultdict
 from decimal import Decimal
-from typing import List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from django.db import transaction
-from django.db.models import F
+from django.db import connection, transaction
+from django.db.models import F, Sum
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from .models import Order, TradingPair, Wallet
+from .utils import AMOUNT_SCALE, PRICE_SCALE, from_units, match_fills, quote_units, to_units
 
 logger = logging.getLogger(__name__)
 
 
+# First key of the two-key advisory lock, so pair locks have their own key
+# space and can't collide with other advisory lock users ('TRAD')
+PAIR_LOCK_NAMESPACE = 0x54524144
+
+
+def _lock_pair(pair_id: int):
+    """
+    Serialise matching and cancels on a pair until the transaction ends.
+
+    PostgreSQL only (pg_advisory_xact_lock); other backends fall back to row
+    locks in find_matches.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(%s, %s)", [PAIR_LOCK_NAMESPACE, pair_id]
+            )
+
+
 class InsufficientBalanceError(Exception):
     def __init__(self, required: Decimal, available: Decimal, currency: str):
         self.required = required
@@ -38,11 +60,15 @@ class WalletService:
     """Handles wallet operations - deposits, withdrawals, balance locking."""
 
     def get_or_create_wallet(self, user: User, currency: str) -> Wallet:
-        wallet, _ = Wallet.objects.get_or_create(
-            user=user,
-            currency=currency.upper(),
-            defaults={'balance': Decimal('0'), 'locked_balance': Decimal('0')}
-        )
+        # Plain SELECT in the common case; ON CONFLICT DO NOTHING covers the
+        # race without the savepoint get_or_create wraps around its INSERT
+        currency = currency.upper()
+        wallet = Wallet.objects.filter(user=user, currency=currency).first()
+        if wallet is None:
+            Wallet.objects.bulk_create(
+                [Wallet(user=user, currency=currency)], ignore_conflicts=True
+            )
+            wallet = Wallet.objects.get(user=user, currency=currency)
         return wallet
 
     def get_wallet(self, user: User, currency: str) -> Wallet:
@@ -70,82 +96,111 @@ class WalletService:
         if amount <= 0:
             raise ValueError("Withdrawal amount must be positive")
 
-        wallet = Wallet.objects.select_for_update().get(
-            user=user, currency=currency.upper()
-        )
+        # Balance check folded into the UPDATE - no separate locking read
+        updated = Wallet.objects.filter(
+            user=user,
+            currency=currency.upper(),
+            balance__gte=F('locked_balance') + amount
+        ).update(balance=F('balance') - amount)
 
-        if wallet.available_balance < amount:
+        if not updated:
+            wallet = self.get_wallet(user, currency)
             raise InsufficientBalanceError(amount, wallet.available_balance, currency)
 
-        wallet.balance -= amount
-        wallet.save()
-
         logger.info(f"Withdrawal: {amount} {currency} from user {user.id}")
-        return wallet
+        return self.get_wallet(user, currency)
 
     @transaction.atomic
     def lock_balance(self, user: User, currency: str, amount: Decimal) -> Wallet:
         """Lock balance for a pending order."""
-        if amount <= 0:
-            raise ValueError("Lock amount must be positive")
-
-        wallet = Wallet.objects.select_for_update().get(
-            user=user, currency=currency.upper()
-        )
-
-        if wallet.available_balance < amount:
-            raise InsufficientBalanceError(amount, wallet.available_balance, currency)
-
-        wallet.locked_balance += amount
-        wallet.save()
-        return wallet
+        self.apply_lock(user.id, currency, amount)
+        return self.get_wallet(user, currency)
 
     @transaction.atomic
     def unlock_balance(self, user: User, currency: str, amount: Decimal) -> Wallet:
         """Unlock balance when order is cancelled."""
-        if amount <= 0:
-            raise ValueError("Unlock amount must be positive")
+        self.apply_unlock(user.id, currency, amount)
+        return self.get_wallet(user, currency)
 
-        wallet = Wallet.objects.select_for_update().get(
-            user=user, currency=currency.upper()
-        )
-
-        if wallet.locked_balance < amount:
-            raise ValueError(f"Can't unlock {amount}: only {wallet.locked_balance} locked")
-
-        wallet.locked_balance -= amount
-        wallet.save()
-        return wallet
+    def apply_lock(self, user_id: int, currency: str, amount: Decimal):
+        """lock_balance without reading the wallet back - one UPDATE on success."""
+        if amount <= 0:
+            raise ValueError("Lock amount must be positive")
 
-    @transaction.atomic
-    def transfer_locked(
-        self,
-        from_user: User,
-        to_user: User,
-        currency: str,
-        amount: Decimal
-    ) -> Tuple[Wallet, Wallet]:
-        """Transfer from locked balance to another user's available balance."""
+        updated = Wallet.objects.filter(
+            user_id=user_id,
+            currency=currency.upper(),
+            balance__gte=F('locked_balance') + amount
+        ).update(locked_balance=F('locked_balance') + amount)
+
+        if not updated:
+            row = Wallet.objects.filter(
+                user_id=user_id, currency=currency.upper()
+            ).values_list('balance', 'locked_balance').first()
+            if row is None:
+                raise WalletNotFoundError(user_id, currency)
+            raise InsufficientBalanceError(amount, row[0] - row[1], currency)
+
+    def apply_unlock(self, user_id: int, currency: str, amount: Decimal):
+        """unlock_balance without reading the wallet back - one UPDATE on success."""
         if amount <= 0:
-            raise ValueError("Transfer amount must be positive")
+            raise ValueError("Unlock amount must be positive")
 
-        from_wallet = Wallet.objects.select_for_update().get(
-            user=from_user, currency=currency.upper()
+        updated = Wallet.objects.filter(
+            user_id=user_id,
+            currency=currency.upper(),
+            locked_balance__gte=amount
+        ).update(locked_balance=F('locked_balance') - amount)
+
+        if not updated:
+            locked = Wallet.objects.filter(
+                user_id=user_id, currency=currency.upper()
+            ).values_list('locked_balance', flat=True).first()
+            if locked is None:
+                raise WalletNotFoundError(user_id, currency)
+            raise ValueError(f"Can't unlock {amount}: only {locked} locked")
+
+    def lock_wallets(
+        self, keys: Iterable[Tuple[int, str]]
+    ) -> Dict[Tuple[int, str], Wallet]:
+        """
+        SELECT ... FOR UPDATE every (user_id, currency) wallet in one query.
+
+        Rows are locked in (user_id, currency) order. That only rules out
+        deadlocks if it's the one multi-row wallet lock in the transaction -
+        pass every wallet the caller needs here rather than locking some of
+        them beforehand.
+
+        Missing wallets are created empty first, so a user receiving a currency
+        they've never held still gets a row. That INSERT runs before any row
+        is locked, so waiting on someone else's insert of the same key never
+        happens while we hold locks out of order.
+        """
+        keys = sorted(set(keys))
+        Wallet.objects.bulk_create(
+            [Wallet(user_id=user_id, currency=currency) for user_id, currency in keys],
+            ignore_conflicts=True
         )
 
-        if from_wallet.locked_balance < amount:
-            raise ValueError(f"Can't transfer {amount}: only {from_wallet.locked_balance} locked")
-
-        from_wallet.locked_balance -= amount
-        from_wallet.balance -= amount
-        from_wallet.save()
-
-        to_wallet = self.get_or_create_wallet(to_user, currency)
-        to_wallet = Wallet.objects.select_for_update().get(pk=to_wallet.pk)
-        to_wallet.balance += amount
-        to_wallet.save()
-
-        return from_wallet, to_wallet
+        qs = Wallet.objects.select_for_update().filter(
+            user_id__in={user_id for user_id, _ in keys},
+            currency__in={currency for _, currency in keys}
+        ).order_by('user_id', 'currency')
+        wanted = set(keys)
+        return {(w.user_id, w.currency): w for w in qs if (w.user_id, w.currency) in wanted}
+
+    def save_wallets(self, wallets: Iterable[Wallet]):
+        """Write back wallets mutated in memory, refusing negative balances."""
+        wallets = list(wallets)
+        for wallet in wallets:
+            if wallet.balance < 0 or wallet.locked_balance < 0:
+                raise ValueError(
+                    f"Can't settle {wallet.currency} for user {wallet.user_id}: "
+                    f"balance {wallet.balance}, locked {wallet.locked_balance}"
+                )
+        Wallet.objects.bulk_update(wallets, ['balance', 'locked_balance'])
+        for wallet in wallets:
+            wallet.__dict__.pop('available_balance', None)
 
 
 class OrderValidationService:
@@ -153,9 +208,8 @@ class OrderValidationService:
 
     MIN_ORDER_VALUE = Decimal('10.00')
     MAX_ORDER_VALUE = Decimal('1000000.00')
-
-    def __init__(self):
-        self.wallet_svc = WalletService()
+    MIN_ORDER_UNITS = to_units(MIN_ORDER_VALUE, AMOUNT_SCALE)
+    MAX_ORDER_UNITS = to_units(MAX_ORDER_VALUE, AMOUNT_SCALE)
 
     def validate(
         self,
@@ -181,28 +235,38 @@ class OrderValidationService:
         if amount <= 0:
             raise InvalidOrderError("Amount must be positive")
 
-        order_value = price * amount
-        if order_value < self.MIN_ORDER_VALUE:
+        # Beyond the columns' precision the backend would round the stored
+        # order differently from the lock we take, so refuse it outright.
+        # normalize() so trailing zeros (10.500) don't count.
+        if price.normalize().as_tuple().exponent < -2:
+            raise InvalidOrderError("Price can have at most 2 decimal places")
+        if amount.normalize().as_tuple().exponent < -8:
+            raise InvalidOrderError("Amount can have at most 8 decimal places")
+
+        amount_units = to_units(amount, AMOUNT_SCALE)
+        value_units = quote_units(to_units(price, PRICE_SCALE), amount_units)
+        if value_units < self.MIN_ORDER_UNITS:
             raise InvalidOrderError(f"Min order value is {self.MIN_ORDER_VALUE}")
-        if order_value > self.MAX_ORDER_VALUE:
+        if value_units > self.MAX_ORDER_UNITS:
             raise InvalidOrderError(f"Max order value is {self.MAX_ORDER_VALUE}")
 
         # Check balance
         if side == 'BUY':
-            required = price * amount
+            required_units = value_units
             currency = pair.quote_currency
         else:
-            required = amount
+            required_units = amount_units
             currency = pair.base_currency
 
-        try:
-            wallet = self.wallet_svc.get_wallet(user, currency)
-            available = wallet.available_balance
-        except WalletNotFoundError:
-            available = Decimal('0')
+        row = Wallet.objects.filter(
+            user=user, currency=currency.upper()
+        ).values_list('balance', 'locked_balance').first()
+        available = row[0] - row[1] if row else Decimal('0')
 
-        if available < required:
-            raise InsufficientBalanceError(required, available, currency)
+        if to_units(available, AMOUNT_SCALE) < required_units:
+            raise InsufficientBalanceError(
+                from_units(required_units, AMOUNT_SCALE), available, currency
+            )
 
 
 class OrderMatchingService:
@@ -219,11 +283,15 @@ class OrderMatchingService:
     def find_matches(self, order: Order) -> List[Order]:
         opposite = 'SELL' if order.side == 'BUY' else 'BUY'
 
+        # Only the columns the matching loop reads
         matches = Order.objects.filter(
-            pair=order.pair,
+            pair_id=order.pair_id,
             side=opposite,
             status='OPEN'
-        ).select_for_update()
+        ).only('id', 'user_id', 'side', 'price', 'amount', 'filled_amount', 'status')
+        if connection.vendor != 'postgresql':
+            # No pair lock here, so lock the order rows instead
+            matches = matches.select_for_update()
 
         if order.side == 'BUY':
             # Match with sells at or below our price
@@ -234,62 +302,233 @@ class OrderMatchingService:
 
         return list(matches)
 
-    @transaction.atomic
-    def execute_match(self, taker: Order, maker: Order, qty: Decimal):
-        """Execute a match between taker and maker orders."""
-        price = maker.price
-        value = price * qty
-
-        if taker.side == 'BUY':
-            buyer, seller = taker.user, maker.user
+    def _match_sql(
+        self, order: Order, taker_remaining: int
+    ) -> List[Tuple[int, int, int, int, int]]:
+        """
+        Fill makers for order in a single statement (PostgreSQL only).
+
+        A running SUM() over the crossing makers in price-time priority gives
+        the quantity ahead of each one, so the fill per maker is
+        LEAST(remaining, taker_remaining - ahead). Makers are updated in place
+        and (maker_id, user_id, price_units, qty_units, filled_units) comes back
+        via RETURNING - filled_units being the maker's total after this fill.
+        Candidates aren't row-locked; the caller holds the pair lock.
+        """
+        table = Order._meta.db_table
+        if order.side == 'BUY':
+            opposite, price_cmp, priority = 'SELL', '<=', 'price ASC, created_at ASC, id ASC'
         else:
-            buyer, seller = maker.user, taker.user
-
-        # Transfer base currency (BTC etc) from seller to buyer
-        self.wallet_svc.transfer_locked(
-            seller, buyer, taker.pair.base_currency, qty
-        )
+            opposite, price_cmp, priority = 'BUY', '>=', 'price DESC, created_at ASC, id ASC'
+
+        remaining = from_units(taker_remaining, AMOUNT_SCALE)
+        sql = f"""
+            WITH candidates AS (
+                SELECT id, price, created_at, amount - filled_amount AS rem
+                FROM {table}
+                WHERE pair_id = %s AND side = %s AND status = 'OPEN' AND price {price_cmp} %s
+            ),
+            ranked AS (
+                SELECT id, rem, SUM(rem) OVER (ORDER BY {priority}) - rem AS ahead
+                FROM candidates
+            ),
+            fills AS (
+                SELECT id, LEAST(rem, %s - ahead) AS qty
+                FROM ranked
+                WHERE ahead < %s
+            )
+            UPDATE {table} o
+            SET filled_amount = o.filled_amount + f.qty,
+                status = CASE WHEN o.filled_amount + f.qty >= o.amount THEN 'FILLED' ELSE o.status END,
+                updated_at = %s
+            FROM fills f
+            WHERE o.id = f.id
+            RETURNING o.id, o.user_id, ROUND(o.price * %s)::bigint,
+                (f.qty * %s)::bigint, (o.filled_amount * %s)::bigint
+        """
+        params = [
+            order.pair_id, opposite, order.price,
+            remaining, remaining, timezone.now(), PRICE_SCALE, AMOUNT_SCALE, AMOUNT_SCALE,
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def _match_orm(
+        self, order: Order, taker_remaining: int
+    ) -> List[Tuple[int, int, int, int, int]]:
+        """Portable fallback for _match_sql: walk the book in Python."""
+        makers = self.find_matches(order)
+        # Generator, so makers past the point the taker is filled are skipped
+        quantities = match_fills(taker_remaining, (
+            to_units(maker.amount - maker.filled_amount, AMOUNT_SCALE)
+            for maker in makers
+        ))
+
+        fills = []
+        filled_makers = []
+        for maker, qty in zip(makers, quantities):
+            maker_remaining = to_units(maker.amount - maker.filled_amount, AMOUNT_SCALE)
+            maker.filled_amount += from_units(qty, AMOUNT_SCALE)
+            if qty == maker_remaining:
+                maker.status = 'FILLED'
+            fills.append((
+                maker.id, maker.user_id, to_units(maker.price, PRICE_SCALE), qty,
+                to_units(maker.filled_amount, AMOUNT_SCALE)
+            ))
+            filled_makers.append(maker)
+
+        if filled_makers:
+            now = timezone.now()
+            for maker in filled_makers:
+                maker.updated_at = now
+            Order.objects.bulk_update(filled_makers, ['filled_amount', 'status', 'updated_at'])
+
+        return fills
+
+    def execute_match(
+        self,
+        taker: Order,
+        maker_id: int,
+        buyer_id: int,
+        seller_id: int,
+        price_units: int,
+        qty_units: int,
+        value_units: int,
+        base: str,
+        quote: str,
+        balance_deltas: Dict[Tuple[int, str], int],
+        locked_deltas: Dict[Tuple[int, str], int]
+    ):
+        """
+        Book one fill's wallet transfers into the delta dicts, in place.
+
+        Deltas are integer units keyed by (user_id, currency); match_order
+        applies them to the locked wallets once every fill is booked.
+        """
+        # Seller's locked base goes to the buyer
+        balance_deltas[(seller_id, base)] -= qty_units
+        locked_deltas[(seller_id, base)] -= qty_units
+        balance_deltas[(buyer_id, base)] += qty_units
+
+        # Buyer's locked quote goes to the seller
+        balance_deltas[(buyer_id, quote)] -= value_units
+        locked_deltas[(buyer_id, quote)] -= value_units
+        balance_deltas[(seller_id, quote)] += value_units
 
-        # Transfer quote currency (GBP etc) from buyer to seller
-        self.wallet_svc.transfer_locked(
-            buyer, seller, taker.pair.quote_currency, value
+        logger.info(
+            f"Trade: {from_units(qty_units, AMOUNT_SCALE)} {base} "
+            f"@ {from_units(price_units, PRICE_SCALE)} (orders {taker.id}/{maker_id})"
         )
 
-        # Update filled amounts
-        taker.filled_amount += qty
-        maker.filled_amount += qty
+    @transaction.atomic
+    def match_order(
+        self,
+        order: Order,
+        lock_currency: Optional[str] = None,
+        lock_units: int = 0
+    ) -> int:
+        """
+        Try to match order against the book. Returns number of trades.
+
+        lock_units of lock_currency are locked in the taker's wallet first,
+        in the same ordered acquisition as the makers' wallets - raises
+        InsufficientBalanceError if the taker can't cover it.
+
+        The caller must already hold the pair lock (_lock_pair) - the book is
+        read without row locks on PostgreSQL.
+        """
+        amount_units = to_units(order.amount, AMOUNT_SCALE)
+        taker_remaining = amount_units - to_units(order.filled_amount, AMOUNT_SCALE)
+
+        if connection.vendor == 'postgresql':
+            fills = self._match_sql(order, taker_remaining)
+        else:
+            fills = self._match_orm(order, taker_remaining)
 
-        if taker.filled_amount >= taker.amount:
-            taker.status = 'FILLED'
-        if maker.filled_amount >= maker.amount:
-            maker.status = 'FILLED'
+        if not fills:
+            if lock_units:
+                # Only one wallet row, so no lock order to get wrong
+                self.wallet_svc.apply_lock(
+                    order.user_id, lock_currency, from_units(lock_units, AMOUNT_SCALE)
+                )
+            return 0
 
-        taker.save()
-        maker.save()
+        # place_order hands over the pair instance, so this is no query
+        base = order.pair.base_currency
+        quote = order.pair.quote_currency
 
-        logger.info(
-            f"Trade: {qty} {taker.pair.base_currency} @ {price} "
-            f"(orders {taker.id}/{maker.id})"
+        # Everyone in this run pays one currency of the pair and receives the
+        # other, so lock both for all of them up front in a single query
+        user_ids = {order.user_id} | {fill[1] for fill in fills}
+        wallets = self.wallet_svc.lock_wallets(
+            (user_id, currency) for user_id in user_ids for currency in (base, quote)
         )
 
-    @transaction.atomic
-    def match_order(self, order: Order) -> int:
-        """Try to match order against the book. Returns number of trades."""
-        matches = self.find_matches(order)
-        trades = 0
-
-        for maker in matches:
-            taker_remaining = order.amount - order.filled_amount
-            maker_remaining = maker.amount - maker.filled_amount
-
-            if taker_remaining <= 0:
-                break
+        # The taker's side is fixed for the whole run, so settle who buys and
+        # who sells once rather than per fill
+        taker_id = order.user_id
+        taker_filled_before = amount_units - taker_remaining
+        if order.side == 'BUY':
+            trades = [
+                (maker_id, taker_id, maker_user_id, price_units, qty_units,
+                 quote_units(price_units, qty_units))
+                for maker_id, maker_user_id, price_units, qty_units, _ in fills
+            ]
+        else:
+            # The maker is the buyer and locked at this same price, so charge
+            # the step in its cumulative value. Its fills then add up to exactly
+            # what place_order locked and cancel_order has no dust to strand.
+            trades = [
+                (maker_id, maker_user_id, taker_id, price_units, qty_units,
+                 quote_units(price_units, filled_units)
+                 - quote_units(price_units, filled_units - qty_units))
+                for maker_id, maker_user_id, price_units, qty_units, filled_units in fills
+            ]
+
+        balance_deltas: Dict[Tuple[int, str], int] = defaultdict(int)
+        locked_deltas: Dict[Tuple[int, str], int] = defaultdict(int)
+
+        if lock_units:
+            taker_wallet = wallets[(taker_id, lock_currency)]
+            available = taker_wallet.balance - taker_wallet.locked_balance
+            if to_units(available, AMOUNT_SCALE) < lock_units:
+                raise InsufficientBalanceError(
+                    from_units(lock_units, AMOUNT_SCALE), available, lock_currency
+                )
+            locked_deltas[(taker_id, lock_currency)] += lock_units
 
-            qty = min(taker_remaining, maker_remaining)
-            self.execute_match(order, maker, qty)
-            trades += 1
+        for maker_id, buyer_id, seller_id, price_units, qty_units, value_units in trades:
+            self.execute_match(
+                order, maker_id, buyer_id, seller_id, price_units, qty_units,
+                value_units, base, quote, balance_deltas, locked_deltas
+            )
+            taker_remaining -= qty_units
 
-        return trades
+        if order.side == 'BUY':
+            # A buying taker locked at its own price but paid the makers'.
+            # Release its lock for the filled quantity the same way cancel_order
+            # would, so price improvement and rounding come back to it.
+            taker_filled = amount_units - taker_remaining
+            price_units = to_units(order.price, PRICE_SCALE)
+            released = (
+                quote_units(price_units, taker_filled)
+                - quote_units(price_units, taker_filled_before)
+            )
+            charged = sum(trade[5] for trade in trades)
+            locked_deltas[(taker_id, quote)] -= released - charged
+
+        for key, wallet in wallets.items():
+            wallet.balance += from_units(balance_deltas[key], AMOUNT_SCALE)
+            wallet.locked_balance += from_units(locked_deltas[key], AMOUNT_SCALE)
+        self.wallet_svc.save_wallets(wallets.values())
+
+        order.filled_amount = from_units(amount_units - taker_remaining, AMOUNT_SCALE)
+        if taker_remaining <= 0:
+            order.status = 'FILLED'
+        order.save(update_fields=['filled_amount', 'status', 'updated_at'])
+
+        return len(fills)
 
 
 class OrderService:
@@ -313,13 +552,20 @@ class OrderService:
         # Validate
         self.validator.validate(user, pair, side, order_type, price, amount)
 
-        # Lock balance
+        # Take the pair lock before any wallet row lock - match_order takes
+        # them in that order, so the other way round can deadlock
+        _lock_pair(pair.id)
+
+        # Funds to lock. Not locked with the INSERT in one statement: that took
+        # the taker's wallet ahead of the makers' and could deadlock, so
+        # match_order locks them alongside the makers' wallets instead.
         if side == 'BUY':
-            self.wallet_svc.lock_balance(user, pair.quote_currency, price * amount)
+            currency = pair.quote_currency
+            lock_units = quote_units(to_units(price, PRICE_SCALE), to_units(amount, AMOUNT_SCALE))
         else:
-            self.wallet_svc.lock_balance(user, pair.base_currency, amount)
+            currency = pair.base_currency
+            lock_units = to_units(amount, AMOUNT_SCALE)
 
-        # Create order
         order = Order.objects.create(
             user=user,
             pair=pair,
@@ -332,38 +578,65 @@ class OrderService:
 
         logger.info(f"Order {order.id}: {side} {amount} {pair.symbol} @ {price}")
 
-        # Try to match
-        trades = self.matcher.match_order(order)
-        if trades:
-            order.refresh_from_db()
+        # Lock funds and try to match - fills are applied to this instance in
+        # place. If the lock fails the whole placement rolls back.
+        self.matcher.match_order(order, currency, lock_units)
 
         return order
 
     @transaction.atomic
     def cancel_order(self, user: User, order_id: int) -> Order:
-        order = Order.objects.select_for_update().get(id=order_id)
-
+        # Everything the unlock needs, in the one read
+        order = Order.objects.select_related('pair').only(
+            'user_id', 'pair_id', 'side', 'price', 'amount', 'filled_amount', 'status',
+            'pair__base_currency', 'pair__quote_currency'
+        ).filter(id=order_id).first()
+        if order is None:
+            raise Order.DoesNotExist(f"No order {order_id}")
         if order.user_id != user.id:
             raise InvalidOrderError("Not your order")
 
-        if order.status not in ('PENDING', 'OPEN'):
-            raise InvalidOrderError(f"Can't cancel {order.status} order")
+        # Matching reads the book without row locks, so wait out any match
+        # running on this pair before touching the order
+        _lock_pair(order.pair_id)
+
+        # Flipping the status first takes the row lock, so a concurrent
+        # cancel can't make us unlock twice. Matching on filled_amount too
+        # means a fill that landed after our read is caught, not over-unlocked.
+        while True:
+            if order.status not in ('PENDING', 'OPEN'):
+                raise InvalidOrderError(f"Can't cancel {order.status} order")
+            order.updated_at = timezone.now()
+            cancelled = Order.objects.filter(
+                id=order_id, status=order.status, filled_amount=order.filled_amount
+            ).update(status='CANCELLED', updated_at=order.updated_at)
+            if cancelled:
+                break
+            order.refresh_from_db(fields=['filled_amount', 'status'])
+        order.status = 'CANCELLED'
 
-        unfilled = order.amount - order.filled_amount
+        amount_units = to_units(order.amount, AMOUNT_SCALE)
+        filled_units = to_units(order.filled_amount, AMOUNT_SCALE)
+        unfilled_units = amount_units - filled_units
 
-        if unfilled > 0:
+        if unfilled_units > 0:
+            # Whatever's left of the place_order lock - fills release it in
+            # cumulative steps, so this leaves no rounding dust behind
             if order.side == 'BUY':
-                self.wallet_svc.unlock_balance(
-                    user, order.pair.quote_currency, order.price * unfilled
+                price_units = to_units(order.price, PRICE_SCALE)
+                value_units = (
+                    quote_units(price_units, amount_units)
+                    - quote_units(price_units, filled_units)
                 )
+                if value_units > 0:
+                    self.wallet_svc.apply_unlock(
+                        user.id, order.pair.quote_currency, from_units(value_units, AMOUNT_SCALE)
+                    )
             else:
-                self.wallet_svc.unlock_balance(
-                    user, order.pair.base_currency, unfilled
+                self.wallet_svc.apply_unlock(
+                    user.id, order.pair.base_currency, from_units(unfilled_units, AMOUNT_SCALE)
                 )
 
-        order.status = 'CANCELLED'
-        order.save()
-
         logger.info(f"Order {order.id} cancelled")
         return order
 
@@ -380,11 +653,24 @@ class OrderService:
             qs = qs.filter(pair=pair)
         return qs.order_by('-created_at')
 
-    def get_order_book(self, pair: TradingPair, side: Optional[str] = None) -> List[Order]:
+    def get_order_book(
+        self,
+        pair: TradingPair,
+        side: Optional[str] = None,
+        depth: int = 50
+    ) -> List[Order]:
         qs = Order.objects.filter(pair=pair, status='OPEN')
         if side:
             qs = qs.filter(side=side)
 
         if side == 'BUY':
-            return list(qs.order_by('-price', 'created_at'))
-        return list(qs.order_by('price', 'created_at'))
+            return list(qs.order_by('-price', 'created_at')[:depth])
+        return list(qs.order_by('price', 'created_at')[:depth])
+
+    def get_price_levels(self, pair: TradingPair, side: str, depth: int = 50) -> List[dict]:
+        """Open quantity per price, best first - one row per level, not per order."""
+        qs = Order.objects.filter(pair=pair, side=side, status='OPEN').values('price').annotate(
+            qty=Sum(F('amount') - F('filled_amount'))
+        )
+        ordering = '-price' if side == 'BUY' else 'price'
+        return list(qs.order_by(ordering)[:depth])
@@ -0,0 +1,14 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import TradingPair
+from .admin import PAIR_CHOICES_CACHE_KEY
+
+
+@receiver(post_save, sender=TradingPair)
+@receiver(post_delete, sender=TradingPair)
+def clear_pair_cache(sender, **kwargs):
+    # After commit, so another worker can't re-cache the old list in between
+    transaction.on_commit(lambda: cache.delete(PAIR_CHOICES_CACHE_KEY))
@@ -1,3 +1,393 @@
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
 
-# Create your tests here.
+from .admin import CachedPairListFilter, EstimatedCountPaginator, get_pair_choices
+from .models import Order, TradingPair, Wallet
+from .services import (
+    PAIR_LOCK_NAMESPACE,
+    InsufficientBalanceError,
+    InvalidOrderError,
+    OrderMatchingService,
+    OrderService,
+    WalletService,
+)
+
+D = Decimal
+
+
+class TradingTestMixin:
+    """BTC/GBP pair, a buyer holding GBP and two sellers holding BTC."""
+
+    def setUp(self):
+        self.pair = TradingPair.objects.create(
+            symbol='BTC/GBP', base_currency='BTC', quote_currency='GBP'
+        )
+        self.buyer = User.objects.create_user('buyer')
+        self.seller_a = User.objects.create_user('seller_a')
+        self.seller_b = User.objects.create_user('seller_b')
+
+        self.wallets = WalletService()
+        self.wallets.deposit(self.buyer, 'GBP', D('100000'))
+        self.wallets.deposit(self.seller_a, 'BTC', D('2'))
+        self.wallets.deposit(self.seller_b, 'BTC', D('2'))
+
+        self.orders = OrderService()
+
+    def place(self, user, side, price, amount):
+        return self.orders.place_order(user, self.pair, side, 'LIMIT', D(price), D(amount))
+
+    def assertWallet(self, user, currency, balance, locked):
+        wallet = Wallet.objects.get(user=user, currency=currency)
+        self.assertEqual(
+            (wallet.balance, wallet.locked_balance), (D(balance), D(locked)),
+            f"{user.username} {currency}"
+        )
+
+
+class OrderServiceTestMixin(TradingTestMixin):
+    """Order scenarios - run on the default database and again on PostgreSQL."""
+
+    def place_asks(self):
+        # s3 shares s1's price but arrived later, so it fills after s1;
+        # s4 is priced above the bid and mustn't be touched
+        return (
+            self.place(self.seller_a, 'SELL', '20000', '0.5'),
+            self.place(self.seller_b, 'SELL', '21000', '0.5'),
+            self.place(self.seller_b, 'SELL', '20000', '0.5'),
+            self.place(self.seller_a, 'SELL', '22000', '1'),
+        )
+
+    def test_fills_makers_in_price_time_order(self):
+        s1, s2, s3, s4 = self.place_asks()
+
+        taker = self.place(self.buyer, 'BUY', '21000', '1.2')
+
+        self.assertEqual(taker.status, 'FILLED')
+        self.assertEqual(taker.filled_amount, D('1.2'))
+        for order in (s1, s2, s3, s4):
+            order.refresh_from_db()
+        self.assertEqual((s1.status, s1.filled_amount), ('FILLED', D('0.5')))
+        self.assertEqual((s3.status, s3.filled_amount), ('FILLED', D('0.5')))
+        self.assertEqual((s2.status, s2.filled_amount), ('OPEN', D('0.2')))
+        self.assertEqual((s4.status, s4.filled_amount), ('OPEN', D('0')))
+
+    def test_taker_rests_when_book_runs_out(self):
+        self.place_asks()
+
+        taker = self.place(self.buyer, 'BUY', '21000', '2')
+
+        taker.refresh_from_db()
+        self.assertEqual((taker.status, taker.filled_amount), ('OPEN', D('1.5')))
+        # 0.5 left on the book at 21000
+        self.assertWallet(self.buyer, 'GBP', '69500', '10500')
+
+    def test_balances_after_buy_fill(self):
+        self.place_asks()
+
+        self.place(self.buyer, 'BUY', '21000', '1.2')
+
+        # Paid 0.5 @ 20000 + 0.5 @ 20000 + 0.2 @ 21000; the lock taken at
+        # 21000 is released in full, price improvement included
+        self.assertWallet(self.buyer, 'GBP', '75800', '0')
+        self.assertWallet(self.buyer, 'BTC', '1.2', '0')
+        self.assertWallet(self.seller_a, 'BTC', '1.5', '1')
+        self.assertWallet(self.seller_a, 'GBP', '10000', '0')
+        self.assertWallet(self.seller_b, 'BTC', '1.3', '0.3')
+        self.assertWallet(self.seller_b, 'GBP', '14200', '0')
+
+    def test_balances_after_sell_fill(self):
+        other_buyer = User.objects.create_user('other_buyer')
+        self.wallets.deposit(other_buyer, 'GBP', D('50000'))
+        b1 = self.place(self.buyer, 'BUY', '20000', '0.5')
+        b2 = self.place(other_buyer, 'BUY', '21000', '0.5')
+
+        taker = self.place(self.seller_a, 'SELL', '19000', '0.8')
+
+        self.assertEqual(taker.status, 'FILLED')
+        b1.refresh_from_db()
+        b2.refresh_from_db()
+        self.assertEqual((b2.status, b1.filled_amount), ('FILLED', D('0.3')))
+        self.assertWallet(self.seller_a, 'BTC', '1.2', '0')
+        self.assertWallet(self.seller_a, 'GBP', '16500', '0')
+        self.assertWallet(other_buyer, 'GBP', '39500', '0')
+        self.assertWallet(other_buyer, 'BTC', '0.5', '0')
+        self.assertWallet(self.buyer, 'GBP', '94000', '4000')
+        self.assertWallet(self.buyer, 'BTC', '0.3', '0')
+
+    def test_order_book_depth_and_price_levels(self):
+        s1, s2, s3, s4 = self.place_asks()
+        self.place(self.buyer, 'BUY', '20000', '0.2')
+        self.place(self.buyer, 'BUY', '18000', '0.5')
+        self.place(self.buyer, 'BUY', '19000', '0.5')
+
+        book = self.orders.get_order_book(self.pair, 'SELL', depth=2)
+        self.assertEqual([order.id for order in book], [s1.id, s3.id])
+
+        asks = self.orders.get_price_levels(self.pair, 'SELL', depth=2)
+        self.assertEqual(
+            [(level['price'], level['qty']) for level in asks],
+            [(D('20000'), D('0.8')), (D('21000'), D('0.5'))]
+        )
+        bids = self.orders.get_price_levels(self.pair, 'BUY')
+        self.assertEqual(
+            [(level['price'], level['qty']) for level in bids],
+            [(D('19000'), D('0.5')), (D('18000'), D('0.5'))]
+        )
+
+    def test_insufficient_balance_inserts_no_order(self):
+        with self.assertRaises(InsufficientBalanceError):
+            self.place(self.buyer, 'BUY', '50000', '3')
+
+        self.assertFalse(Order.objects.exists())
+        self.assertWallet(self.buyer, 'GBP', '100000', '0')
+
+    def test_insufficient_balance_at_lock_rolls_back_fills(self):
+        # Balance moved between validation and the lock - the order and any
+        # maker fills must go with the failed placement
+        ask = self.place(self.seller_a, 'SELL', '20000', '1')
+
+        with mock.patch.object(self.orders.validator, 'validate'):
+            with self.assertRaises(InsufficientBalanceError):
+                self.place(self.buyer, 'BUY', '20000', '6')
+
+        self.assertEqual(list(Order.objects.values_list('id', flat=True)), [ask.id])
+        ask.refresh_from_db()
+        self.assertEqual((ask.status, ask.filled_amount), ('OPEN', D('0')))
+        self.assertWallet(self.buyer, 'GBP', '100000', '0')
+        self.assertWallet(self.seller_a, 'BTC', '2', '1')
+
+    def test_rejects_price_and_amount_beyond_column_precision(self):
+        with self.assertRaisesMessage(InvalidOrderError, "at most 2 decimal places"):
+            self.place(self.buyer, 'BUY', '20000.005', '0.3')
+        with self.assertRaisesMessage(InvalidOrderError, "at most 8 decimal places"):
+            self.place(self.seller_a, 'SELL', '20000', '0.300000001')
+
+        self.assertFalse(Order.objects.exists())
+        self.assertWallet(self.buyer, 'GBP', '100000', '0')
+
+        # Trailing zeros are fine
+        order = self.place(self.buyer, 'BUY', '20000.500', '0.30000000000')
+        self.assertWallet(self.buyer, 'GBP', '100000', '6000.15')
+        order.refresh_from_db()
+        self.assertEqual((order.price, order.amount), (D('20000.5'), D('0.3')))
+
+    def test_cancel_unlocks_unfilled_sell(self):
+        ask = self.place(self.seller_a, 'SELL', '20000', '1')
+        self.place(self.buyer, 'BUY', '20000', '0.4')
+
+        cancelled = self.orders.cancel_order(self.seller_a, ask.id)
+
+        self.assertEqual(cancelled.status, 'CANCELLED')
+        self.assertWallet(self.seller_a, 'BTC', '1.6', '0')
+
+    def test_cancel_unlocks_rounding_dust(self):
+        # 3.33 * 10.00000001 isn't a whole number of 1e-8 units, and neither
+        # are the fills - every unit locked must still come back
+        self.wallets.deposit(self.seller_a, 'BTC', D('2'))
+        self.wallets.deposit(self.seller_b, 'BTC', D('2'))
+        bid = self.place(self.buyer, 'BUY', '3.33', '10.00000001')
+        self.assertWallet(self.buyer, 'GBP', '100000', '33.30000003')
+        self.place(self.seller_a, 'SELL', '3.33', '3.10000001')
+        self.place(self.seller_b, 'SELL', '3.33', '3.10000001')
+
+        self.orders.cancel_order(self.buyer, bid.id)
+
+        bid.refresh_from_db()
+        self.assertEqual((bid.status, bid.filled_amount), ('CANCELLED', D('6.20000002')))
+        self.assertWallet(self.buyer, 'GBP', '99979.35399994', '0')
+        self.assertWallet(self.buyer, 'BTC', '6.20000002', '0')
+        seller_gbp = Wallet.objects.filter(
+            user__in=[self.seller_a, self.seller_b], currency='GBP'
+        ).values_list('balance', flat=True)
+        self.assertEqual(sum(seller_gbp), D('20.64600006'))
+
+    def test_cancel_checks_owner_and_status(self):
+        ask = self.place(self.seller_a, 'SELL', '20000', '1')
+
+        with self.assertRaisesMessage(InvalidOrderError, "Not your order"):
+            self.orders.cancel_order(self.seller_b, ask.id)
+        self.orders.cancel_order(self.seller_a, ask.id)
+        with self.assertRaisesMessage(InvalidOrderError, "Can't cancel CANCELLED order"):
+            self.orders.cancel_order(self.seller_a, ask.id)
+        with self.assertRaises(Order.DoesNotExist):
+            self.orders.cancel_order(self.seller_a, ask.id + 1000)
+
+        self.assertWallet(self.seller_a, 'BTC', '2', '0')
+
+
+class OrderServiceTests(OrderServiceTestMixin, TestCase):
+    pass
+
+
+@skipUnless(connection.vendor == 'postgresql', 'PostgreSQL only')
+class PostgresOrderServiceTests(OrderServiceTestMixin, TestCase):
+    """Same scenarios, pinned to the raw SQL matcher and the pair lock."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(
+            OrderMatchingService, '_match_orm', side_effect=AssertionError('ORM matcher used')
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_match_holds_pair_lock(self):
+        self.place(self.seller_a, 'SELL', '20000', '1')
+        self.place(self.buyer, 'BUY', '20000', '0.5')
+
+        # Transaction-scoped, so it's still held inside the test's transaction
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND classid = %s "
+                "AND objid = %s AND pid = pg_backend_pid()",
+                [PAIR_LOCK_NAMESPACE, self.pair.id]
+            )
+            self.assertIsNotNone(cursor.fetchone())
+
+
+@skipUnless(connection.vendor == 'postgresql', 'PostgreSQL only')
+class PostgresMigrationTests(TestCase):
+    def test_open_order_indexes_built_and_valid(self):
+        # 0002 builds these CONCURRENTLY; a failed build leaves them invalid
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname, i.indisvalid FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = ANY(%s)",
+                [['open_orders_idx', 'open_orders_desc_idx', 'user_open_orders_idx']]
+            )
+            rows = dict(cursor.fetchall())
+        self.assertEqual(rows, {
+            'open_orders_idx': True, 'open_orders_desc_idx': True, 'user_open_orders_idx': True,
+        })
+
+
+class AdminTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.admin)
+        self.btc = TradingPair.objects.create(symbol='BTC/GBP', base_currency='BTC', quote_currency='GBP')
+        self.eth = TradingPair.objects.create(symbol='ETH/GBP', base_currency='ETH', quote_currency='GBP')
+
+    def create_orders(self, pair, count):
+        for i in range(count):
+            Order.objects.create(
+                user=self.admin, pair=pair, side='BUY', price=D('100') + i,
+                amount=D('1'), status='OPEN'
+            )
+
+    def test_pair_choices_cached_and_cleared_on_save_and_delete(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_pair_choices(), ((self.btc.id, 'BTC/GBP'), (self.eth.id, 'ETH/GBP')))
+        with self.assertNumQueries(0):
+            get_pair_choices()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sol = TradingPair.objects.create(symbol='SOL/GBP', base_currency='SOL', quote_currency='GBP')
+        self.assertIn((sol.id, 'SOL/GBP'), get_pair_choices())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.eth.delete()
+        self.assertEqual(get_pair_choices(), ((self.btc.id, 'BTC/GBP'), (sol.id, 'SOL/GBP')))
+
+    def test_order_changelist_pair_filter(self):
+        self.create_orders(self.btc, 2)
+        self.create_orders(self.eth, 1)
+
+        response = self.client.get('/admin/trading/order/')
+        self.assertEqual(response.status_code, 200)
+        pair_filter = next(
+            spec for spec in response.context['cl'].filter_specs
+            if isinstance(spec, CachedPairListFilter)
+        )
+        self.assertEqual(
+            list(pair_filter.lookup_choices), [(self.btc.id, 'BTC/GBP'), (self.eth.id, 'ETH/GBP')]
+        )
+
+        response = self.client.get(f'/admin/trading/order/?pair__id__exact={self.eth.id}')
+        self.assertEqual(
+            [order.pair_id for order in response.context['cl'].result_list], [self.eth.id]
+        )
+
+    def test_paginator_counts_filtered_and_small_querysets_exactly(self):
+        self.create_orders(self.btc, 3)
+        self.create_orders(self.eth, 2)
+
+        with mock.patch.object(EstimatedCountPaginator, 'ESTIMATE_THRESHOLD', 0):
+            filtered = EstimatedCountPaginator(Order.objects.filter(pair=self.eth).order_by('id'), 10)
+            self.assertEqual(filtered.count, 2)
+        unfiltered = EstimatedCountPaginator(Order.objects.order_by('id'), 10)
+        self.assertEqual(unfiltered.count, 5)
+
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL only')
+    def test_paginator_uses_planner_estimate_for_unfiltered_listing(self):
+        self.create_orders(self.btc, 3)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Order._meta.db_table}")
+        # Not in the estimate until the next ANALYZE
+        self.create_orders(self.eth, 2)
+
+        with mock.patch.object(EstimatedCountPaginator, 'ESTIMATE_THRESHOLD', 0):
+            with self.assertNumQueries(1):
+                self.assertEqual(EstimatedCountPaginator(Order.objects.order_by('id'), 10).count, 3)
+            self.assertEqual(
+                EstimatedCountPaginator(Order.objects.filter(pair=self.eth).order_by('id'), 10).count, 2
+            )
+
+    def test_wallet_changelist_sorts_by_available(self):
+        for name, balance, locked in (('a', '10', '8'), ('b', '5', '0'), ('c', '7', '6')):
+            Wallet.objects.create(
+                user=User.objects.create_user(name), currency='GBP',
+                balance=D(balance), locked_balance=D(locked)
+            )
+
+        # available_balance is the fifth column in list_display
+        response = self.client.get('/admin/trading/wallet/?o=5')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(w.user.username, w._available) for w in response.context['cl'].result_list],
+            [('c', D('1')), ('a', D('2')), ('b', D('5'))]
+        )
+
+
+class WalletServiceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('holder')
+        self.wallets = WalletService()
+        self.wallets.deposit(self.user, 'gbp', D('100'))
+
+    def test_lock_and_unlock(self):
+        wallet = self.wallets.lock_balance(self.user, 'GBP', D('60'))
+        self.assertEqual((wallet.locked_balance, wallet.available_balance), (D('60'), D('40')))
+
+        with self.assertRaises(InsufficientBalanceError):
+            self.wallets.lock_balance(self.user, 'GBP', D('40.00000001'))
+        with self.assertRaises(ValueError):
+            self.wallets.unlock_balance(self.user, 'GBP', D('61'))
+
+        wallet = self.wallets.unlock_balance(self.user, 'GBP', D('60'))
+        self.assertEqual(wallet.locked_balance, D('0'))
+
+    def test_withdraw_respects_locked_balance(self):
+        self.wallets.lock_balance(self.user, 'GBP', D('30'))
+
+        with self.assertRaises(InsufficientBalanceError):
+            self.wallets.withdraw(self.user, 'GBP', D('70.00000001'))
+        wallet = self.wallets.withdraw(self.user, 'GBP', D('70'))
+
+        self.assertEqual((wallet.balance, wallet.locked_balance), (D('30'), D('30')))
+
+    def test_available_balance_follows_save(self):
+        wallet = self.wallets.get_wallet(self.user, 'GBP')
+        self.assertEqual(wallet.available_balance, D('100'))
+
+        wallet.balance += D('5')
+        wallet.save()
+
+        self.assertEqual(wallet.available_balance, D('105'))
@@ -0,0 +1,43 @@
+"""
+Fixed-point helpers.
+
+Prices and amounts are mirrored as scaled integers so the matching hot path
+can use int arithmetic instead of Decimal. Convert back at the edges.
+"""
+
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Iterable, List
+
+AMOUNT_SCALE = 10 ** 8  # amounts and wallet balances, 8dp
+PRICE_SCALE = 10 ** 2  # prices, 2dp
+
+
+def to_units(value: Decimal, scale: int) -> int:
+    # Half away from zero, same as PostgreSQL numeric when storing a DecimalField
+    return int((value * scale).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def from_units(units: int, scale: int) -> Decimal:
+    return Decimal(units) / scale
+
+
+def quote_units(price_units: int, amount_units: int) -> int:
+    """Value of amount at price, in AMOUNT_SCALE units of the quote currency (rounded down)."""
+    return price_units * amount_units // PRICE_SCALE
+
+
+def match_fills(taker_remaining: int, maker_remainings: Iterable[int]) -> List[int]:
+    """
+    Fill quantity per maker, in priority order, until the taker is done.
+
+    Stops consuming maker_remainings as soon as the taker is filled, so the
+    result is only as long as the number of makers actually hit.
+    """
+    fills = []
+    for maker_remaining in maker_remainings:
+        if taker_remaining <= 0:
+            break
+        qty = min(taker_remaining, maker_remaining)
+        fills.append(qty)
+        taker_remaining -= qty
+    return fills